@@ -1,10 +1,23 @@
 import base64
+import concurrent.futures
+import io
+import os
 import pytest
 import requests
+import struct
+import subprocess
+import threading
 import uuid
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = "http://127.0.0.1:8000"
+PROCESSOR_METRICS_URL = os.environ.get('PROCESSOR_METRICS_URL', "http://127.0.0.1:9100/metrics")
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def extra(flag):
+    return pytest.mark.skipif(os.environ.get(flag) != '1', reason=f'additional part, enable with {flag}=1')
 
 @pytest.fixture(scope='module')
 def user_data():
@@ -12,8 +25,7 @@ def user_data():
     password = 'password228'
     return {'username': username, 'password': password}
 
-@pytest.fixture(scope='module')
-def auth_token(user_data):
+def register_and_login(user_data):
     register_url = f"{BASE_URL}/register"
     login_url = f"{BASE_URL}/login"
 
@@ -28,6 +40,13 @@ def auth_token(user_data):
 
     return data['token']
 
+def new_auth_token():
+    return register_and_login({'username': f'user_{uuid.uuid4()}', 'password': 'password228'})
+
+@pytest.fixture(scope='module')
+def auth_token(user_data):
+    return register_and_login(user_data)
+
 def test_register_user(user_data):
     register_url = f"{BASE_URL}/register"
     response = requests.post(register_url, json=user_data)
@@ -43,17 +62,15 @@ def test_login_user(user_data):
 def get_code_processor_payload():
     return {"translator": "python3", "code": "print('Hello, stdout world!')"}
 
-def get_image_processor_payload():
+def get_image_bytes():
     with open("static/sigma.png", "rb") as image_file:
-        image_bytes = image_file.read()
+        return image_file.read()
 
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+def get_image_processor_payload():
+    image_base64 = base64.b64encode(get_image_bytes()).decode('utf-8')
     return {"filter": {"name": "Negative"}, "image": image_base64}
 
-def test_create_task(auth_token):
-    task_url = f"{BASE_URL}/task"
-    headers = {'Authorization': f'Bearer {auth_token}'}
-
+def get_payload():
     payload = dict()
     # payload = get_code_processor_payload()
     # payload = get_image_processor_payload()
@@ -62,6 +79,60 @@ def test_create_task(auth_token):
     if len(payload) == 0:
         raise NotImplemented("Choose one of the variants for payload!")
 
+    return payload
+
+def add_png_text_chunk(image_bytes, text):
+    data = b'Comment\x00' + text.encode('latin-1')
+    chunk = b'tEXt' + data
+    chunk = struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+    iend = image_bytes.rindex(b'IEND') - 4
+    return image_bytes[:iend] + chunk + image_bytes[iend:]
+
+def strip_png_text_chunks(image_bytes):
+    chunks, offset = [image_bytes[:8]], 8
+    while offset < len(image_bytes):
+        length = struct.unpack('>I', image_bytes[offset:offset + 4])[0]
+        end = offset + 12 + length
+        if image_bytes[offset + 4:offset + 8] != b'tEXt':
+            chunks.append(image_bytes[offset:end])
+        offset = end
+    return b''.join(chunks)
+
+def get_unique_payload():
+    payload = get_payload()
+    nonce = uuid.uuid4().hex
+
+    if 'code' in payload:
+        comment = '#' if payload['translator'].startswith('python') else '//'
+        payload['code'] += f"\n{comment} {nonce}\n"
+    else:
+        image_bytes = add_png_text_chunk(base64.b64decode(payload['image']), nonce)
+        payload['image'] = base64.b64encode(image_bytes).decode('utf-8')
+    return payload
+
+def get_metric(name, url=f"{BASE_URL}/metrics", **labels):
+    response = requests.get(url)
+    assert response.status_code == 200
+
+    total = 0.0
+    for line in response.text.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        metric, value = line.rsplit(' ', 1)
+        metric_name, _, metric_labels = metric.partition('{')
+        if metric_name != name:
+            continue
+        if any(f'{key}="{label}"' not in metric_labels for key, label in labels.items()):
+            continue
+        total += float(value)
+    return total
+
+def test_create_task(auth_token):
+    task_url = f"{BASE_URL}/task"
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    payload = get_payload()
+
     response = requests.post(task_url, headers=headers, json=payload) 
 
     assert response.status_code == 201
@@ -70,13 +141,10 @@ def test_create_task(auth_token):
 
     return data['task_id']
 
-def test_task_status_and_result(auth_token):
-    task_id = test_create_task(auth_token)
+def wait_for_task(task_id, headers, interval=3):
     status_url = f"{BASE_URL}/status/{task_id}"
-    result_url = f"{BASE_URL}/result/{task_id}"
-    headers = {'Authorization': f'Bearer {auth_token}'}
 
-    retry = 10
+    retry = int(30 / interval)
     while retry >= 0:
         response = requests.get(status_url, headers=headers)
         assert response.status_code == 200
@@ -88,9 +156,16 @@ def test_task_status_and_result(auth_token):
          
         assert data['status'] == 'in_progress', f'undefined status: {data['status']}!'
         retry -= 1
-        time.sleep(3)
+        time.sleep(interval)
     assert retry > 0, "task is still in progress!"
 
+def test_task_status_and_result(auth_token):
+    task_id = test_create_task(auth_token)
+    result_url = f"{BASE_URL}/result/{task_id}"
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+
+    wait_for_task(task_id, headers)
+
     response = requests.get(result_url, headers=headers)
     assert response.status_code == 200
     data = response.json()
@@ -122,3 +197,836 @@ def test_unauthorized_access():
 
     response = requests.get(result_url)
     assert response.status_code == 401
+
+
+def create_multipart_image_task(headers, image_bytes):
+    files = {
+        'filter': (None, '{"name": "Negative"}', 'application/json'),
+        'image': ('sigma.png', image_bytes, 'image/png'),
+    }
+    response = requests.post(f"{BASE_URL}/task", headers=headers, files=files)
+    assert response.status_code == 201
+    return response.json()['task_id'], len(response.request.body)
+
+def create_raw_image_task(headers, image_bytes):
+    raw_headers = {**headers, 'Content-Type': 'image/png'}
+    response = requests.post(f"{BASE_URL}/task", headers=raw_headers, params={'filter': 'Negative'}, data=image_bytes)
+    assert response.status_code == 201
+    return response.json()['task_id'], len(response.request.body)
+
+def create_base64_image_task(headers, image_bytes):
+    payload = {"filter": {"name": "Negative"}, "image": base64.b64encode(image_bytes).decode('utf-8')}
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json=payload)
+    assert response.status_code == 201
+    return response.json()['task_id'], len(response.request.body)
+
+def get_binary_result(task_id, headers):
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('image/png')
+    assert int(response.headers['Content-Length']) == len(response.content)
+    assert response.content.startswith(PNG_SIGNATURE)
+    return response
+
+@extra('BINARY')
+@pytest.mark.parametrize('create_task', [create_multipart_image_task, create_raw_image_task])
+def test_binary_image_task(auth_token, create_task):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_id, _ = create_task(headers, get_image_bytes())
+    wait_for_task(task_id, headers)
+
+    response = get_binary_result(task_id, headers)
+    assert response.headers.get('Accept-Ranges') == 'bytes'
+
+@extra('BINARY')
+def test_binary_result_range(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_id, _ = create_raw_image_task(headers, get_image_bytes())
+    wait_for_task(task_id, headers)
+    result_url = f"{BASE_URL}/result/{task_id}"
+
+    full = get_binary_result(task_id, headers).content
+
+    response = requests.get(result_url, headers={**headers, 'Range': 'bytes=0-7'})
+    assert response.status_code == 206
+    assert response.content == PNG_SIGNATURE
+    assert response.headers['Content-Range'] == f'bytes 0-7/{len(full)}'
+
+    response = requests.get(result_url, headers={**headers, 'Range': 'bytes=8-'})
+    assert response.status_code == 206
+    assert response.content == full[8:]
+
+    response = requests.get(result_url, headers={**headers, 'Range': f'bytes={len(full) + 1}-'})
+    assert response.status_code == 416
+
+@extra('BINARY')
+def test_binary_vs_base64_transfer(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    json_headers = {**headers, 'Accept': 'application/json'}
+
+    # each upload carries its own nonce, otherwise the second one is served from the result cache
+    start = time.monotonic()
+    task_id, base64_sent = create_base64_image_task(headers, add_png_text_chunk(get_image_bytes(), uuid.uuid4().hex))
+    wait_for_task(task_id, headers, interval=0.05)
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=json_headers)
+    assert response.status_code == 200
+    base64_received = len(response.content)
+    base64_result = base64.b64decode(response.json()['result'])
+    base64_latency = time.monotonic() - start
+
+    start = time.monotonic()
+    task_id, binary_sent = create_raw_image_task(headers, add_png_text_chunk(get_image_bytes(), uuid.uuid4().hex))
+    wait_for_task(task_id, headers, interval=0.05)
+    binary_result = get_binary_result(task_id, headers).content
+    binary_latency = time.monotonic() - start
+
+    print(f"\nbase64: sent {base64_sent} B, received {base64_received} B, {base64_latency:.3f}s")
+    print(f"binary: sent {binary_sent} B, received {len(binary_result)} B, {binary_latency:.3f}s")
+
+    assert strip_png_text_chunks(binary_result) == strip_png_text_chunks(base64_result)
+    assert binary_sent < base64_sent
+    assert len(binary_result) < base64_received
+
+@extra('CACHE')
+def test_repeated_task_cache(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    task_url = f"{BASE_URL}/task"
+    payload = get_unique_payload()
+    misses_before = get_metric('task_cache_misses_total')
+
+    start = time.monotonic()
+    response = requests.post(task_url, headers=headers, json=payload)
+    assert response.status_code == 201
+    first_id = response.json()['task_id']
+    assert get_metric('task_cache_misses_total') == misses_before + 1
+    wait_for_task(first_id, headers, interval=0.05)
+    first_latency = time.monotonic() - start
+    first_result = requests.get(f"{BASE_URL}/result/{first_id}", headers=headers).json()['result']
+
+    hits_before = get_metric('task_cache_hits_total')
+
+    start = time.monotonic()
+    response = requests.post(task_url, headers=headers, json=payload)
+    assert response.status_code == 201
+    repeat_id = response.json()['task_id']
+    response = requests.get(f"{BASE_URL}/status/{repeat_id}", headers=headers)
+    repeat_latency = time.monotonic() - start
+
+    print(f"\nfirst: {first_latency * 1000:.2f}ms, repeat: {repeat_latency * 1000:.2f}ms")
+
+    assert repeat_id != first_id
+    assert response.json()['status'] == 'ready', "repeated task must be resolved from cache on POST /task"
+    assert requests.get(f"{BASE_URL}/result/{repeat_id}", headers=headers).json()['result'] == first_result
+    assert get_metric('task_cache_hits_total') == hits_before + 1
+
+def run_code_task(headers, code, translator="python3", stdin=None):
+    payload = {"translator": translator, "code": code}
+    if stdin is not None:
+        payload["stdin"] = stdin
+
+    start = time.monotonic()
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json=payload)
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+    wait_for_task(task_id, headers, interval=0.05)
+    latency = time.monotonic() - start
+
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+    assert response.status_code == 200
+    return response.json()['result'], latency
+
+@extra('POOL')
+def test_warm_sandbox_pool(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    hits_before = get_metric('sandbox_pool_hits_total', PROCESSOR_METRICS_URL)
+
+    latencies = []
+    for i in range(10):
+        _, latency = run_code_task(headers, f"print('Hello, stdout world! {i} {uuid.uuid4()}')")
+        latencies.append(latency)
+
+    latencies.sort()
+    print(f"\np50: {latencies[len(latencies) // 2] * 1000:.1f}ms, max: {latencies[-1] * 1000:.1f}ms")
+    print(f"pool wait: {get_metric('sandbox_pool_wait_seconds_sum', PROCESSOR_METRICS_URL):.3f}s total")
+
+    assert get_metric('sandbox_pool_hits_total', PROCESSOR_METRICS_URL) - hits_before >= 9
+
+@extra('POOL')
+def test_warm_sandbox_isolation(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    # relative path: the pool only promises to clean the sandbox working directory
+    marker = f"leak_{uuid.uuid4().hex}"
+
+    run_code_task(headers, f"open('{marker}', 'w').write('dirty')")
+    for _ in range(5):
+        # the nonce keeps the checks out of the result cache
+        result, _ = run_code_task(headers, f"import os; print('dirty' if os.path.exists('{marker}') else 'clean')  # {uuid.uuid4()}")
+        assert 'clean' in str(result), "sandbox state leaked between submissions"
+
+C_ECHO_PROGRAM = """
+#include <stdio.h>
+
+int main() {
+    char line[256];
+    if (fgets(line, sizeof(line), stdin)) {
+        printf("echo: %s", line);
+    }
+    return 0;
+}
+"""
+
+@extra('COMPILE_CACHE')
+def test_compile_cache(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    # unique comment makes the first build a guaranteed miss
+    code = f"// {uuid.uuid4()}\n{C_ECHO_PROGRAM}"
+    misses_before = get_metric('compile_cache_misses_total', PROCESSOR_METRICS_URL)
+    hits_before = get_metric('compile_cache_hits_total', PROCESSOR_METRICS_URL)
+
+    result, cold_latency = run_code_task(headers, code, translator="gcc", stdin="cold\n")
+    assert 'echo: cold' in str(result)
+
+    latencies = []
+    for i in range(5):
+        result, latency = run_code_task(headers, code, translator="gcc", stdin=f"warm {i}\n")
+        assert f'echo: warm {i}' in str(result)
+        latencies.append(latency)
+
+    latencies.sort()
+    warm_latency = latencies[len(latencies) // 2]
+    print(f"\ncold: {cold_latency * 1000:.1f}ms, warm p50: {warm_latency * 1000:.1f}ms")
+
+    assert get_metric('compile_cache_misses_total', PROCESSOR_METRICS_URL) - misses_before == 1
+    assert get_metric('compile_cache_hits_total', PROCESSOR_METRICS_URL) - hits_before == 5
+    assert warm_latency < cold_latency
+
+def run_image_task(headers, image_bytes, image_filter=None, filters=None):
+    payload = {"image": base64.b64encode(image_bytes).decode('utf-8')}
+    if filters is not None:
+        payload["filters"] = filters
+    else:
+        payload["filter"] = image_filter
+    json_headers = {**headers, 'Accept': 'application/json'}
+
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json=payload)
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+    wait_for_task(task_id, headers, interval=0.05)
+
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=json_headers)
+    assert response.status_code == 200
+    return base64.b64decode(response.json()['result'])
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+BENCHMARK_FILTERS = [
+    {"name": "Negative"},
+    {"name": "FlipX"},
+    {"name": "Blur", "parameters": {"sigma": 3}},
+    {"name": "Sharpen", "parameters": {"sigma": 1}},
+]
+
+@extra('PARALLEL_FILTERS')
+def test_parallel_filters_match_reference(auth_token):
+    Image = pytest.importorskip('PIL.Image')
+    ImageOps = pytest.importorskip('PIL.ImageOps')
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    source = Image.open(io.BytesIO(get_image_bytes())).convert('RGBA')
+
+    result = Image.open(io.BytesIO(run_image_task(headers, encode_png(source), {"name": "Negative"}))).convert('RGBA')
+    r, g, b, a = source.split()
+    expected = Image.merge('RGBA', (*ImageOps.invert(Image.merge('RGB', (r, g, b))).split(), a))
+    assert result.tobytes() == expected.tobytes()
+
+    result = Image.open(io.BytesIO(run_image_task(headers, encode_png(source), {"name": "FlipX"}))).convert('RGBA')
+    assert result.tobytes() == ImageOps.flip(source).tobytes()
+
+    # a flat image stays flat under any convolution: a missing halo row shows up as a seam between tiles
+    flat = Image.new('RGBA', (1280, 2160), (128, 64, 200, 255))
+    for image_filter in BENCHMARK_FILTERS[2:]:
+        result = Image.open(io.BytesIO(run_image_task(headers, encode_png(flat), image_filter))).convert('RGBA')
+        assert result.getcolors() == [(1280 * 2160, (128, 64, 200, 255))], f"seams after {image_filter['name']}"
+
+@extra('PARALLEL_FILTERS')
+def test_parallel_filters_benchmark(auth_token):
+    Image = pytest.importorskip('PIL.Image')
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    source = Image.open(io.BytesIO(get_image_bytes()))
+    workers = int(get_metric('image_filter_workers', PROCESSOR_METRICS_URL))
+
+    print(f"\nworkers: {workers}")
+    for scale in (1, 2, 4):
+        image = source.resize((source.width * scale, source.height * scale), Image.NEAREST)
+        image_bytes = encode_png(image)
+        megapixels = image.width * image.height / 1e6
+
+        for image_filter in BENCHMARK_FILTERS:
+            name = image_filter['name']
+            before = get_metric('image_filter_seconds_sum', PROCESSOR_METRICS_URL, filter=name)
+            # unique bytes with the same pixels keep the result cache out of the measurement
+            run_image_task(headers, add_png_text_chunk(image_bytes, uuid.uuid4().hex), image_filter)
+            elapsed = get_metric('image_filter_seconds_sum', PROCESSOR_METRICS_URL, filter=name) - before
+            assert elapsed > 0
+            print(f"{image.width}x{image.height} {name}: {megapixels / elapsed:.1f} MP/s on {workers} workers")
+
+PIPELINE_FILTERS = [
+    {"name": "FlipX"},
+    {"name": "Negative"},
+    {"name": "Blur", "parameters": {"sigma": 2}},
+]
+
+@extra('PIPELINE')
+def test_filter_pipeline(auth_token):
+    Image = pytest.importorskip('PIL.Image')
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    source = Image.open(io.BytesIO(get_image_bytes()))
+    image_bytes = encode_png(source.resize((source.width * 2, source.height * 2), Image.NEAREST))
+
+    codec_before = get_metric('image_codec_seconds_sum', PROCESSOR_METRICS_URL)
+    start = time.monotonic()
+    # every step gets a nonce: intermediate results are the same bytes on every run and would hit the result cache
+    chained = image_bytes
+    for image_filter in PIPELINE_FILTERS:
+        chained = run_image_task(headers, add_png_text_chunk(chained, uuid.uuid4().hex), image_filter)
+    chained_latency = time.monotonic() - start
+    chained_codec = get_metric('image_codec_seconds_sum', PROCESSOR_METRICS_URL) - codec_before
+
+    decodes_before = get_metric('image_decode_total', PROCESSOR_METRICS_URL)
+    encodes_before = get_metric('image_encode_total', PROCESSOR_METRICS_URL)
+    codec_before = get_metric('image_codec_seconds_sum', PROCESSOR_METRICS_URL)
+    start = time.monotonic()
+    fused = run_image_task(headers, add_png_text_chunk(image_bytes, uuid.uuid4().hex), filters=PIPELINE_FILTERS)
+    fused_latency = time.monotonic() - start
+    fused_codec = get_metric('image_codec_seconds_sum', PROCESSOR_METRICS_URL) - codec_before
+
+    print(f"\nchained: {chained_latency * 1000:.1f}ms ({chained_codec * 1000:.1f}ms codec)")
+    print(f"pipeline: {fused_latency * 1000:.1f}ms ({fused_codec * 1000:.1f}ms codec)")
+
+    assert get_metric('image_decode_total', PROCESSOR_METRICS_URL) - decodes_before == 1
+    assert get_metric('image_encode_total', PROCESSOR_METRICS_URL) - encodes_before == 1
+    assert Image.open(io.BytesIO(fused)).tobytes() == Image.open(io.BytesIO(chained)).tobytes()
+    assert fused_codec < chained_codec
+
+@extra('PIPELINE')
+def test_filter_pipeline_validation(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    image_base64 = base64.b64encode(get_image_bytes()).decode('utf-8')
+
+    for filters in ([], [{"name": "Negative"}, {"name": "NoSuchFilter"}]):
+        response = requests.post(f"{BASE_URL}/task", headers=headers, json={"filters": filters, "image": image_base64})
+        assert response.status_code == 400
+
+BLUR_SIGMAS = [1, 2, 4, 8, 16, 32, 64]
+
+@extra('FAST_BLUR')
+def test_blur_accuracy(auth_token):
+    Image = pytest.importorskip('PIL.Image')
+    ImageChops = pytest.importorskip('PIL.ImageChops')
+    ImageFilter = pytest.importorskip('PIL.ImageFilter')
+    ImageStat = pytest.importorskip('PIL.ImageStat')
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    source = Image.open(io.BytesIO(get_image_bytes())).convert('RGB')
+
+    for sigma in BLUR_SIGMAS:
+        result = run_image_task(headers, encode_png(source), {"name": "Blur", "parameters": {"sigma": sigma}})
+        result = Image.open(io.BytesIO(result)).convert('RGB')
+        expected = source.filter(ImageFilter.GaussianBlur(radius=sigma))
+
+        error = max(ImageStat.Stat(ImageChops.difference(result, expected)).mean)
+        print(f"\nsigma {sigma}: mean abs error {error:.2f}")
+        assert error < 2.0, f"Blur with sigma {sigma} is too far from gaussian"
+
+@extra('FAST_BLUR')
+def test_blur_radius_benchmark(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    image_bytes = get_image_bytes()
+
+    elapsed = dict()
+    print()
+    for sigma in BLUR_SIGMAS:
+        before = get_metric('image_filter_seconds_sum', PROCESSOR_METRICS_URL, filter='Blur')
+        run_image_task(headers, add_png_text_chunk(image_bytes, uuid.uuid4().hex), {"name": "Blur", "parameters": {"sigma": sigma}})
+        elapsed[sigma] = get_metric('image_filter_seconds_sum', PROCESSOR_METRICS_URL, filter='Blur') - before
+        print(f"sigma {sigma}: {elapsed[sigma] * 1000:.1f}ms")
+
+    assert elapsed[64] < 3 * elapsed[8], "Blur time must not grow with the radius"
+
+# task_id -> time right before its POST
+def submit_tasks_timed(headers, count, tracker=None, make_payload=get_unique_payload):
+    submitted = dict()
+    with requests.Session() as session:
+        for _ in range(count):
+            payload = make_payload()
+            submitted_at = time.monotonic()
+            response = session.post(f"{BASE_URL}/task", headers=headers, json=payload)
+            assert response.status_code == 201
+            submitted[response.json()['task_id']] = submitted_at
+            if tracker is not None:
+                tracker.add(response.json()['task_id'], submitted_at, headers)
+    return submitted
+
+def submit_tasks(headers, count):
+    return list(submit_tasks_timed(headers, count))
+
+def wait_for_all(task_ids, headers, timeout=120):
+    pending = set(task_ids)
+    deadline = time.monotonic() + timeout
+    with requests.Session() as session:
+        while pending and time.monotonic() < deadline:
+            for task_id in list(pending):
+                response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                assert response.status_code == 200
+                if response.json()['status'] == 'ready':
+                    pending.remove(task_id)
+            time.sleep(0.05)
+    assert not pending, f"{len(pending)} tasks are still in progress!"
+
+def run_cmd(env_name, default):
+    result = subprocess.run(os.environ.get(env_name, default), shell=True, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+# acks are flushed in batches, so a counter is read once it stops changing for longer than the flush interval
+def get_settled_metric(name, url, timeout=10):
+    settle = max(0.5, 2 * int(os.environ.get('PROCESSOR_ACK_FLUSH_MS', 100)) / 1000)
+    value = get_metric(name, url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(settle)
+        previous, value = value, get_metric(name, url)
+        if value == previous:
+            return value
+    assert False, f"{name} is still changing after {timeout}s"
+
+@extra('CONSUMER')
+def test_consumer_throughput(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    workers = int(get_metric('processor_workers', PROCESSOR_METRICS_URL))
+
+    start = time.monotonic()
+    for _ in range(3):
+        wait_for_all(submit_tasks(headers, 1), headers)
+    sequential_rate = 3 / (time.monotonic() - start)
+
+    acks_before = get_settled_metric('processor_acks_total', PROCESSOR_METRICS_URL)
+    batches_before = get_metric('processor_ack_batches_total', PROCESSOR_METRICS_URL)
+
+    count = 20 * workers
+    start = time.monotonic()
+    wait_for_all(submit_tasks(headers, count), headers)
+    burst_rate = count / (time.monotonic() - start)
+
+    acks = get_settled_metric('processor_acks_total', PROCESSOR_METRICS_URL) - acks_before
+    batches = get_metric('processor_ack_batches_total', PROCESSOR_METRICS_URL) - batches_before
+    print(f"\n{workers} workers: sequential {sequential_rate:.1f} msg/s, burst {burst_rate:.1f} msg/s, {acks:.0f} acks in {batches:.0f} batches")
+
+    assert acks == count
+    assert batches < acks, "acks are not batched"
+    if workers > 1:
+        assert burst_rate > 1.5 * sequential_rate
+
+@extra('CONSUMER')
+def test_consumer_redelivery_after_crash(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    task_ids = submit_tasks(headers, 50)
+
+    # kill the processor while it holds unacked deliveries: some are in work, some are done but not acked yet
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        statuses = [requests.get(f"{BASE_URL}/status/{task_id}", headers=headers).json()['status'] for task_id in task_ids]
+        if 'ready' in statuses:
+            break
+        time.sleep(0.05)
+    assert 'in_progress' in statuses, "all tasks finished before the crash, submit more of them"
+    run_cmd('PROCESSOR_KILL_CMD', 'docker compose kill processor')
+    run_cmd('PROCESSOR_START_CMD', 'docker compose start processor')
+
+    wait_for_all(task_ids, headers, timeout=300)
+    for task_id in task_ids:
+        response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()['result']
+        assert requests.get(f"{BASE_URL}/status/{task_id}", headers=headers).json()['status'] == 'ready'
+
+@extra('RESULT_QUEUE')
+def test_commit_path(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    mode = os.environ.get('COMMIT_MODE', 'queue')
+    other = 'http' if mode == 'queue' else 'queue'
+
+    commits_before = {path: get_metric('commit_seconds_count', path=path) for path in (mode, other)}
+    latency_before = get_metric('commit_seconds_sum', path=mode)
+    cpu_before = get_metric('process_cpu_seconds_total')
+
+    count = 100
+    wait_for_all(submit_tasks(headers, count), headers)
+
+    commits = get_metric('commit_seconds_count', path=mode) - commits_before[mode]
+    latency = (get_metric('commit_seconds_sum', path=mode) - latency_before) / count
+    cpu = get_metric('process_cpu_seconds_total') - cpu_before
+    print(f"\n{mode}: commit latency {latency * 1000:.2f}ms, API server CPU {cpu * 1000 / count:.2f}ms per task")
+
+    assert commits == count
+    assert get_metric('commit_seconds_count', path=other) == commits_before[other]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def measure_turnaround(headers, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        wait_for_all(submit_tasks(headers, 1), headers)
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+@extra('FAIR_QUEUE')
+def test_fair_share_scheduling():
+    heavy_headers = {'Authorization': f'Bearer {new_auth_token()}'}
+    light_headers = {'Authorization': f'Bearer {new_auth_token()}'}
+
+    idle_p99 = percentile(measure_turnaround(light_headers, 10), 0.99)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        flood = executor.submit(submit_tasks, heavy_headers, 1000)
+        time.sleep(1)
+
+        loaded = measure_turnaround(light_headers, 30)
+        heavy_tasks = flood.result()
+    loaded_p99 = percentile(loaded, 0.99)
+    print(f"\nlight user p99: idle {idle_p99 * 1000:.1f}ms, under flood {loaded_p99 * 1000:.1f}ms")
+
+    wait_for_all(heavy_tasks, heavy_headers, timeout=1800)
+    assert loaded_p99 < 5 * idle_p99 + 1.0, "light user is starved by the heavy one"
+
+@extra('FAIR_QUEUE')
+def test_priority_validation(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json={**get_unique_payload(), "priority": "high"})
+    assert response.status_code == 201
+
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json={**get_unique_payload(), "priority": "urgent!!!"})
+    assert response.status_code == 400
+
+def assert_too_many_requests(response):
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+@extra('ADMISSION')
+def test_user_rate_limit():
+    if float(os.environ.get('RATE_LIMIT_PER_SEC', 10)) == 0:
+        pytest.skip('per-user rate limit is disabled')
+    headers = {'Authorization': f'Bearer {new_auth_token()}'}
+
+    statuses = []
+    with requests.Session() as session:
+        for _ in range(200):
+            response = session.post(f"{BASE_URL}/task", headers=headers, json=get_unique_payload())
+            statuses.append(response.status_code)
+            if response.status_code != 201:
+                assert_too_many_requests(response)
+
+    assert statuses[0] == 201
+    assert 429 in statuses, "200 tasks in a row were not limited"
+
+    # other users are not affected by someone else's bucket
+    other_headers = {'Authorization': f'Bearer {new_auth_token()}'}
+    response = requests.post(f"{BASE_URL}/task", headers=other_headers, json=get_unique_payload())
+    assert response.status_code == 201
+
+# polls tasks in the background while the test keeps submitting, so a task is timed
+# when it becomes ready, not when the test gets around to checking it
+class TurnaroundTracker:
+    def __init__(self, pollers=8, interval=0.05):
+        self.interval = interval
+        self.submitted = dict()
+        self.turnaround = dict()
+        self.shards = [dict() for _ in range(pollers)]
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.aborted = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=pollers)
+        self.pollers = [self.executor.submit(self.poll, shard) for shard in self.shards]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.aborted.set()
+        self.executor.shutdown(wait=True)
+
+    def add(self, task_id, submitted_at, headers):
+        with self.lock:
+            self.shards[len(self.submitted) % len(self.shards)][task_id] = (submitted_at, headers)
+            self.submitted[task_id] = submitted_at
+
+    def poll(self, shard):
+        with requests.Session() as session:
+            while not self.aborted.is_set():
+                with self.lock:
+                    pending = list(shard.items())
+                if not pending and self.closed.is_set():
+                    return
+                for task_id, (submitted_at, headers) in pending:
+                    response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                    assert response.status_code == 200
+                    if response.json()['status'] == 'ready':
+                        with self.lock:
+                            self.turnaround[task_id] = time.monotonic() - submitted_at
+                            del shard[task_id]
+                time.sleep(self.interval)
+
+    # no more tasks will be added; returns task_id -> turnaround in seconds
+    def wait(self, timeout=600):
+        self.closed.set()
+        done, _ = concurrent.futures.wait(self.pollers, timeout=timeout, return_when=concurrent.futures.FIRST_EXCEPTION)
+        self.aborted.set()
+        for poller in done:
+            poller.result()
+        with self.lock:
+            missing = len(self.submitted) - len(self.turnaround)
+            assert missing == 0, f"{missing} tasks are still in progress!"
+            return dict(self.turnaround)
+
+@extra('ADMISSION')
+def test_admission_under_overload():
+    max_depth = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', 500))
+    max_age = int(os.environ.get('ADMISSION_MAX_QUEUE_AGE_MS', 10000)) / 1000
+    if max_depth == 0 and max_age == 0:
+        pytest.skip('global admission control is disabled')
+
+    rps = int(os.environ.get('OVERLOAD_RPS', 100))
+    duration = int(os.environ.get('OVERLOAD_SEC', 30))
+    rate_limit = float(os.environ.get('RATE_LIMIT_PER_SEC', 10))
+    # spread the load so per-user buckets stay half full and only the global controller rejects
+    users = max(1, int(rps / (rate_limit / 2))) if rate_limit > 0 else 10
+    user_headers = [{'Authorization': f'Bearer {new_auth_token()}'} for _ in range(users)]
+
+    idle_p99 = percentile(measure_turnaround(user_headers[0], 10), 0.99)
+    rejected_before = get_metric('admission_rejected_total', reason='queue_depth') + get_metric('admission_rejected_total', reason='queue_age')
+
+    def submit(tracker, submitted_at, headers):
+        response = requests.post(f"{BASE_URL}/task", headers=headers, json=get_unique_payload())
+        if response.status_code == 429:
+            assert_too_many_requests(response)
+            return
+        assert response.status_code == 201
+        tracker.add(response.json()['task_id'], submitted_at, headers)
+
+    # open loop: arrivals follow the schedule no matter how fast the service answers,
+    # admitted tasks are polled while the load is still running
+    with TurnaroundTracker(pollers=32) as tracker:
+        scheduled = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            for i in range(rps * duration):
+                submitted_at = start + i / rps
+                time.sleep(max(0, submitted_at - time.monotonic()))
+                scheduled.append(executor.submit(submit, tracker, submitted_at, user_headers[i % users]))
+            for future in scheduled:
+                future.result()
+
+        rejected = get_metric('admission_rejected_total', reason='queue_depth') + get_metric('admission_rejected_total', reason='queue_age') - rejected_before
+        turnaround = tracker.wait(timeout=1800)
+        admitted = tracker.submitted
+
+    by_arrival = [turnaround[task_id] for task_id in sorted(admitted, key=admitted.get)]
+    third = max(1, len(by_arrival) // 3)
+    first_p99, last_p99 = percentile(by_arrival[:third], 0.99), percentile(by_arrival[-third:], 0.99)
+    loaded_p99 = percentile(by_arrival, 0.99)
+    print(f"\n{rps * duration} submitted at {rps} rps by {users} users: admitted {len(admitted)}, rejected by queue {rejected:.0f}")
+    print(f"p99: idle {idle_p99:.2f}s, overload {loaded_p99:.2f}s, first third {first_p99:.2f}s, last third {last_p99:.2f}s")
+
+    assert rejected > 0, "overload was not detected, raise OVERLOAD_RPS above the service capacity"
+    assert last_p99 < 2 * first_p99 + 1.0, "latency of admitted tasks grows with the queue"
+    assert loaded_p99 < 5 * idle_p99 + max_age + 1.0, "admitted tasks wait in an ever-growing queue"
+
+def get_trace(task_id, headers):
+    # spans are exported asynchronously, give the exporter a moment
+    for _ in range(20):
+        response = requests.get(f"{BASE_URL}/trace/{task_id}", headers=headers)
+        if response.status_code == 200 and any(span['name'] == 'commit' for span in response.json()['spans']):
+            return response.json()
+        time.sleep(0.5)
+    return response.json() if response.status_code == 200 else None
+
+@extra('TRACING')
+def test_task_trace(auth_token):
+    trace_id, client_span_id = uuid.uuid4().hex, uuid.uuid4().hex[:16]
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    traced_headers = {**headers, 'traceparent': f'00-{trace_id}-{client_span_id}-01'}
+
+    response = requests.post(f"{BASE_URL}/task", headers=traced_headers, json=get_unique_payload())
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+    wait_for_task(task_id, headers, interval=0.05)
+
+    trace = get_trace(task_id, headers)
+    assert trace is not None, "trace was not exported"
+    assert trace['trace_id'] == trace_id
+
+    spans = {span['span_id']: span for span in trace['spans']}
+    names = {span['name'] for span in spans.values()}
+    assert {'POST /task', 'queue_wait', 'commit'} <= names
+    assert {span['service'] for span in spans.values()} >= {'api', 'processor'}
+
+    for span in spans.values():
+        assert span['start_time_unix_nano'] <= span['end_time_unix_nano']
+        if span['name'] == 'POST /task':
+            assert span['parent_span_id'] == client_span_id
+            continue
+        assert span['parent_span_id'] in spans, f"span {span['name']} is detached from the trace"
+
+@extra('TRACING')
+def test_unsampled_task_has_no_trace(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    traced_headers = {**headers, 'traceparent': f'00-{uuid.uuid4().hex}-{uuid.uuid4().hex[:16]}-00'}
+
+    response = requests.post(f"{BASE_URL}/task", headers=traced_headers, json=get_unique_payload())
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+    wait_for_task(task_id, headers, interval=0.05)
+
+    response = requests.get(f"{BASE_URL}/trace/{task_id}", headers=headers)
+    assert response.status_code == 404
+
+CHATTY_PROGRAM = """
+import time
+for i in range(50):
+    print(f'line {i}', flush=True)
+    time.sleep(0.1)
+"""
+
+RUNAWAY_PROGRAM = """
+while True:
+    print('x' * 1000)
+"""
+
+@extra('STREAMING')
+def test_follow_output(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json={"translator": "python3", "code": f"{CHATTY_PROGRAM}# {uuid.uuid4()}\n"})
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+
+    start = time.monotonic()
+    first_chunk_at = None
+    output = b''
+    with requests.get(f"{BASE_URL}/result/{task_id}", headers=headers, params={'follow': 1}, stream=True, timeout=60) as response:
+        assert response.status_code == 200
+        for chunk in response.iter_content(chunk_size=None):
+            if first_chunk_at is None and chunk:
+                first_chunk_at = time.monotonic() - start
+            output += chunk
+    total = time.monotonic() - start
+    assert first_chunk_at is not None, "follow stream returned no output"
+    print(f"\nfirst chunk after {first_chunk_at:.2f}s, stream closed after {total:.2f}s")
+
+    lines = [line for line in output.decode().splitlines() if line.startswith('line ')]
+    assert lines == [f'line {i}' for i in range(50)]
+    assert first_chunk_at < total / 2, "output is not streamed while the program runs"
+
+@extra('STREAMING')
+def test_runaway_output_is_capped(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    cap = int(os.environ.get('OUTPUT_MAX_BYTES', 1024 * 1024))
+
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json={"translator": "python3", "code": f"{RUNAWAY_PROGRAM}# {uuid.uuid4()}\n"})
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+    wait_for_task(task_id, headers, interval=0.5)
+
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data.get('truncated') is True
+    assert len(str(data['result'])) <= 2 * cap
+
+@extra('GRACEFUL')
+def test_processor_restart_under_load(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    shutdown_timeout = float(os.environ.get('SHUTDOWN_TIMEOUT_SEC', 10))
+
+    idle_p99 = percentile(measure_turnaround(headers, 10), 0.99)
+
+    # tasks are polled during the waves and the restarts, not after them
+    with TurnaroundTracker() as tracker:
+        for wave in range(4):
+            submit_tasks_timed(headers, 50, tracker)
+            if wave in (1, 2):
+                run_cmd('PROCESSOR_RESTART_CMD', 'docker compose restart processor')
+        # fails if any task was lost during the restarts
+        turnaround = tracker.wait()
+    loaded_p99 = percentile(list(turnaround.values()), 0.99)
+    print(f"\np99: idle {idle_p99:.2f}s, with restarts {loaded_p99:.2f}s")
+    assert loaded_p99 < 5 * idle_p99 + 2 * shutdown_timeout
+
+SLOW_PROGRAM = """
+import time
+time.sleep(5)
+print('done')
+"""
+
+@extra('LEASES')
+@pytest.mark.parametrize('stop_cmd, start_cmd', [
+    (('PROCESSOR_PAUSE_CMD', 'docker compose pause processor'), ('PROCESSOR_UNPAUSE_CMD', 'docker compose unpause processor')),
+    (('PROCESSOR_KILL_CMD', 'docker compose kill processor'), ('PROCESSOR_START_CMD', 'docker compose start processor')),
+])
+def test_stuck_task_is_requeued(auth_token, stop_cmd, start_cmd):
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+    lease_ttl = float(os.environ.get('LEASE_TTL_SEC', 10))
+    requeues_before = get_metric('lease_requeues_total')
+
+    code = f"{SLOW_PROGRAM}# {uuid.uuid4()}\n"
+    response = requests.post(f"{BASE_URL}/task", headers=headers, json={"translator": "python3", "code": code})
+    assert response.status_code == 201
+    task_id = response.json()['task_id']
+
+    time.sleep(1)
+    run_cmd(*stop_cmd)
+    time.sleep(2 * lease_ttl)
+    run_cmd(*start_cmd)
+
+    wait_for_all([task_id], headers, timeout=60)
+    response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+    assert response.status_code == 200
+    assert 'done' in str(response.json()['result'])
+    assert get_metric('lease_requeues_total') > requeues_before
+
+# only tasks marked pure may be run twice by a hedge
+def get_pure_payload():
+    payload = get_unique_payload()
+    if 'code' in payload:
+        payload['pure'] = True
+    return payload
+
+@extra('HEDGING')
+def test_speculative_execution(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    hedging = os.environ.get('HEDGING_ENABLED', '1') == '1'
+    max_ratio = float(os.environ.get('HEDGE_MAX_RATIO', 0.1))
+    metrics = ['hedged_tasks_total', 'hedge_wins_total', 'hedge_cancelled_total', 'hedge_wasted_seconds_total']
+    before = {metric: get_metric(metric) for metric in metrics}
+
+    # paced arrivals, polled in the background so stragglers are timed as they finish
+    with TurnaroundTracker() as tracker:
+        for _ in range(200):
+            submit_tasks_timed(headers, 1, tracker, get_pure_payload)
+            time.sleep(0.05)
+        turnaround = list(tracker.wait().values())
+
+    delta = {metric: get_metric(metric) - before[metric] for metric in metrics}
+    print(f"\nhedging {'on' if hedging else 'off'}: p50 {percentile(turnaround, 0.5):.2f}s, p99 {percentile(turnaround, 0.99):.2f}s")
+    print(f"hedged {delta['hedged_tasks_total']:.0f}/{len(turnaround)}, won {delta['hedge_wins_total']:.0f}, "
+          f"cancelled {delta['hedge_cancelled_total']:.0f}, wasted {delta['hedge_wasted_seconds_total']:.1f}s")
+
+    if not hedging:
+        assert delta['hedged_tasks_total'] == 0
+        return
+    assert delta['hedged_tasks_total'] > 0, "no stragglers were hedged, is one of the processors slowed down?"
+    assert delta['hedged_tasks_total'] <= max_ratio * len(turnaround) + 1
+    assert delta['hedge_wins_total'] <= delta['hedged_tasks_total']
@@ -0,0 +1,571 @@
+import base64
+import concurrent.futures
+import os
+import pytest
+import requests
+import struct
+import threading
+import uuid
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = "http://127.0.0.1:8000"
+PROCESSOR_URL = os.environ.get('PROCESSOR_URL', "http://127.0.0.1:9100")
+PROCESSOR_METRICS_URL = os.environ.get('PROCESSOR_METRICS_URL', f"{PROCESSOR_URL}/metrics")
+PROFILE_TARGETS = {'api': BASE_URL, 'processor': PROCESSOR_URL}
+AUTOSCALER_METRICS_URL = os.environ.get('AUTOSCALER_METRICS_URL', "http://127.0.0.1:9200/metrics")
+
+def extra(flag):
+    return pytest.mark.skipif(os.environ.get(flag) != '1', reason=f'additional part, enable with {flag}=1')
+
+def fetch_profile(url, seconds):
+    response = requests.get(f"{url}/debug/profile", params={'seconds': seconds}, timeout=seconds + 30)
+    assert response.status_code == 200
+    return response.text
+
+@pytest.fixture(autouse=True)
+def profile_capture(request):
+    profile_dir = os.environ.get('PROFILE_OUT')
+    # the profiling test takes its own profile, and only one can be taken at a time
+    if not profile_dir or request.node.name == 'test_profile_under_load':
+        yield
+        return
+
+    seconds = int(os.environ.get('PROFILE_SECONDS', 10))
+    with ThreadPoolExecutor(max_workers=len(PROFILE_TARGETS)) as executor:
+        profiles = {service: executor.submit(fetch_profile, url, seconds) for service, url in PROFILE_TARGETS.items()}
+        yield
+
+        os.makedirs(profile_dir, exist_ok=True)
+        for service, profile in profiles.items():
+            with open(os.path.join(profile_dir, f"{request.node.name}.{service}.folded"), 'w') as profile_file:
+                profile_file.write(profile.result())
+
+@pytest.fixture(scope='module')
+def user_data():
+    username = f'user_{uuid.uuid4()}'
+    password = 'password228'
+    return {'username': username, 'password': password}
+
+def register_and_login(user_data):
+    register_url = f"{BASE_URL}/register"
+    login_url = f"{BASE_URL}/login"
+
+    response = requests.post(register_url, json=user_data)
+    assert response.status_code == 201
+
+    response = requests.post(login_url, json=user_data)
+    assert response.status_code == 200
+
+    data = response.json()
+    assert 'token' in data
+
+    return data['token']
+
+def new_auth_token():
+    return register_and_login({'username': f'user_{uuid.uuid4()}', 'password': 'password228'})
+
+@pytest.fixture(scope='module')
+def auth_token(user_data):
+    return register_and_login(user_data)
+
+def test_register_user(user_data):
+    register_url = f"{BASE_URL}/register"
+    response = requests.post(register_url, json=user_data)
+    assert response.status_code == 201
+
+def test_login_user(user_data):
+    login_url = f"{BASE_URL}/login"
+    response = requests.post(login_url, json=user_data)
+    assert response.status_code == 200
+    data = response.json()
+    assert 'token' in data
+
+def get_code_processor_payload():
+    return {"translator": "python3", "code": "print('Hello, stdout world!')"}
+
+def get_image_bytes():
+    with open("static/sigma.png", "rb") as image_file:
+        return image_file.read()
+
+def get_image_processor_payload():
+    image_base64 = base64.b64encode(get_image_bytes()).decode('utf-8')
+    return {"filter": {"name": "Negative"}, "image": image_base64}
+
+def get_payload():
+    payload = dict()
+    # payload = get_code_processor_payload()
+    # payload = get_image_processor_payload()
+
+
+    if len(payload) == 0:
+        raise NotImplemented("Choose one of the variants for payload!")
+
+    return payload
+
+def add_png_text_chunk(image_bytes, text):
+    data = b'Comment\x00' + text.encode('latin-1')
+    chunk = b'tEXt' + data
+    chunk = struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+    iend = image_bytes.rindex(b'IEND') - 4
+    return image_bytes[:iend] + chunk + image_bytes[iend:]
+
+def get_unique_payload():
+    payload = get_payload()
+    nonce = uuid.uuid4().hex
+
+    if 'code' in payload:
+        comment = '#' if payload['translator'].startswith('python') else '//'
+        payload['code'] += f"\n{comment} {nonce}\n"
+    else:
+        image_bytes = add_png_text_chunk(base64.b64decode(payload['image']), nonce)
+        payload['image'] = base64.b64encode(image_bytes).decode('utf-8')
+    return payload
+
+def get_metric(name, url=f"{BASE_URL}/metrics", **labels):
+    response = requests.get(url)
+    assert response.status_code == 200
+
+    total = 0.0
+    for line in response.text.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        metric, value = line.rsplit(' ', 1)
+        metric_name, _, metric_labels = metric.partition('{')
+        if metric_name != name:
+            continue
+        if any(f'{key}="{label}"' not in metric_labels for key, label in labels.items()):
+            continue
+        total += float(value)
+    return total
+
+def test_create_task(auth_token):
+    task_url = f"{BASE_URL}/task"
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    payload = get_payload()
+
+    response = requests.post(task_url, headers=headers, json=payload) 
+
+    assert response.status_code == 201
+    data = response.json()
+    assert 'task_id' in data
+
+    return data['task_id']
+
+def wait_for_task(task_id, headers, interval=3):
+    status_url = f"{BASE_URL}/status/{task_id}"
+
+    retry = int(30 / interval)
+    while retry >= 0:
+        response = requests.get(status_url, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert 'status' in data
+        
+        if data['status'] == 'ready':
+            break
+         
+        assert data['status'] == 'in_progress', f'undefined status: {data['status']}!'
+        retry -= 1
+        time.sleep(interval)
+    assert retry > 0, "task is still in progress!"
+
+def test_task_status_and_result(auth_token):
+    task_id = test_create_task(auth_token)
+    result_url = f"{BASE_URL}/result/{task_id}"
+    headers = {'Authorization': f'Bearer {auth_token}', 'Accept': 'application/json'}
+
+    wait_for_task(task_id, headers)
+
+    response = requests.get(result_url, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert 'result' in data
+
+def test_task_not_found(auth_token):
+    invalid_task_id = str(uuid.uuid4())
+    status_url = f"{BASE_URL}/status/{invalid_task_id}"
+    result_url = f"{BASE_URL}/result/{invalid_task_id}"
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    response = requests.get(status_url, headers=headers)
+    assert response.status_code == 404
+
+    response = requests.get(result_url, headers=headers)
+    assert response.status_code == 404
+
+def test_unauthorized_access():
+    invalid_task_id = str(uuid.uuid4())
+    status_url = f"{BASE_URL}/status/{invalid_task_id}"
+    result_url = f"{BASE_URL}/result/{invalid_task_id}"
+    task_url = f"{BASE_URL}/task"
+
+    response = requests.post(task_url)
+    assert response.status_code == 401
+
+    response = requests.get(status_url)
+    assert response.status_code == 401
+
+    response = requests.get(result_url)
+    assert response.status_code == 401
+
+# task_id -> time right before its POST
+def submit_tasks_timed(headers, count, tracker=None, make_payload=get_unique_payload):
+    submitted = dict()
+    with requests.Session() as session:
+        for _ in range(count):
+            payload = make_payload()
+            submitted_at = time.monotonic()
+            response = session.post(f"{BASE_URL}/task", headers=headers, json=payload)
+            assert response.status_code == 201
+            submitted[response.json()['task_id']] = submitted_at
+            if tracker is not None:
+                tracker.add(response.json()['task_id'], submitted_at, headers)
+    return submitted
+
+def submit_tasks(headers, count, make_payload=get_unique_payload):
+    return list(submit_tasks_timed(headers, count, make_payload=make_payload))
+
+def wait_for_all(task_ids, headers, timeout=120):
+    pending = set(task_ids)
+    deadline = time.monotonic() + timeout
+    with requests.Session() as session:
+        while pending and time.monotonic() < deadline:
+            for task_id in list(pending):
+                response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                assert response.status_code == 200
+                if response.json()['status'] == 'ready':
+                    pending.remove(task_id)
+            time.sleep(0.05)
+    assert not pending, f"{len(pending)} tasks are still in progress!"
+
+# polls tasks in the background while the test keeps submitting, so a task is timed
+# when it becomes ready, not when the test gets around to checking it
+class TurnaroundTracker:
+    def __init__(self, pollers=8, interval=0.05):
+        self.interval = interval
+        self.submitted = dict()
+        self.turnaround = dict()
+        self.shards = [dict() for _ in range(pollers)]
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.aborted = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=pollers)
+        self.pollers = [self.executor.submit(self.poll, shard) for shard in self.shards]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.aborted.set()
+        self.executor.shutdown(wait=True)
+
+    def add(self, task_id, submitted_at, headers):
+        with self.lock:
+            self.shards[len(self.submitted) % len(self.shards)][task_id] = (submitted_at, headers)
+            self.submitted[task_id] = submitted_at
+
+    def poll(self, shard):
+        with requests.Session() as session:
+            while not self.aborted.is_set():
+                with self.lock:
+                    pending = list(shard.items())
+                if not pending and self.closed.is_set():
+                    return
+                for task_id, (submitted_at, headers) in pending:
+                    response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                    assert response.status_code == 200
+                    if response.json()['status'] == 'ready':
+                        with self.lock:
+                            self.turnaround[task_id] = time.monotonic() - submitted_at
+                            del shard[task_id]
+                time.sleep(self.interval)
+
+    # no more tasks will be added; returns task_id -> turnaround in seconds
+    def wait(self, timeout=600):
+        self.closed.set()
+        done, _ = concurrent.futures.wait(self.pollers, timeout=timeout, return_when=concurrent.futures.FIRST_EXCEPTION)
+        self.aborted.set()
+        for poller in done:
+            poller.result()
+        with self.lock:
+            missing = len(self.submitted) - len(self.turnaround)
+            assert missing == 0, f"{missing} tasks are still in progress!"
+            return dict(self.turnaround)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def poll_status(headers, task_id, count):
+    start = time.monotonic()
+    with requests.Session() as session:
+        for _ in range(count):
+            response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+            assert response.status_code == 200
+    return count / (time.monotonic() - start)
+
+@extra('SESSION_CACHE')
+def test_session_cache_polling(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_id = submit_tasks(headers, 1)[0]
+    poll_status(headers, task_id, 10)
+
+    hits_before = get_metric('session_cache_hits_total')
+    misses_before = get_metric('session_cache_misses_total')
+
+    count = 2000
+    rate = poll_status(headers, task_id, count)
+
+    hits = get_metric('session_cache_hits_total') - hits_before
+    misses = get_metric('session_cache_misses_total') - misses_before
+    print(f"\nstatus polling: {rate:.0f} req/s, session cache hit rate {hits / max(hits + misses, 1):.2%}")
+
+    if os.environ.get('SESSION_CACHE_SIZE') != '0':
+        assert hits / count > 0.9
+
+@extra('SESSION_CACHE')
+def test_logout_invalidates_cached_session():
+    token = new_auth_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    task_id = submit_tasks(headers, 1)[0]
+
+    # warm up the cache with this session
+    poll_status(headers, task_id, 5)
+
+    response = requests.post(f"{BASE_URL}/logout", headers=headers)
+    assert response.status_code == 200
+
+    response = requests.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+    assert response.status_code == 401
+
+    response = requests.post(f"{BASE_URL}/logout", headers=headers)
+    assert response.status_code == 401
+
+def concurrent_status_polling(headers, task_ids, threads=32, requests_per_thread=200):
+    def poll(task_id):
+        with requests.Session() as session:
+            for _ in range(requests_per_thread):
+                response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                assert response.status_code == 200
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(poll, [task_ids[i % len(task_ids)] for i in range(threads)]))
+    return threads * requests_per_thread / (time.monotonic() - start)
+
+@extra('DB_POOL')
+def test_connection_pool(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_ids = submit_tasks(headers, 10)
+    concurrent_status_polling(headers, task_ids, threads=4, requests_per_thread=10)
+
+    opened_before = get_metric('db_pool_connections_opened_total')
+    checkouts_before = get_metric('db_pool_checkouts_total')
+    wait_before = get_metric('db_pool_wait_seconds_sum')
+
+    rate = concurrent_status_polling(headers, task_ids)
+
+    opened = get_metric('db_pool_connections_opened_total') - opened_before
+    checkouts = get_metric('db_pool_checkouts_total') - checkouts_before
+    wait = get_metric('db_pool_wait_seconds_sum') - wait_before
+    print(f"\nstatus: {rate:.0f} req/s, {checkouts:.0f} checkouts, {wait * 1000 / max(checkouts, 1):.3f}ms avg wait, {opened:.0f} new connections")
+
+    assert checkouts > 0
+    assert opened <= get_metric('db_pool_max_connections'), "connections are opened per request"
+    assert get_metric('db_pool_connections', state='in_use') <= get_metric('db_pool_max_connections')
+
+def measure_status_latency(headers, task_ids, count=1000):
+    latencies = []
+    with requests.Session() as session:
+        for i in range(count):
+            start = time.monotonic()
+            response = session.get(f"{BASE_URL}/status/{task_ids[i % len(task_ids)]}", headers=headers)
+            latencies.append(time.monotonic() - start)
+            assert response.status_code == 200
+    return latencies
+
+@extra('BLOB_STORE')
+def test_blob_store_dedup(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    writes_before = get_metric('blob_store_writes_total')
+    dedup_before = get_metric('blob_store_dedup_total')
+
+    # unique payloads with the same meaning produce byte-identical results
+    first, second = submit_tasks(headers, 2)
+    wait_for_all([first, second], headers)
+
+    results = []
+    for task_id in (first, second):
+        response = requests.get(f"{BASE_URL}/result/{task_id}", headers=headers)
+        assert response.status_code == 200
+        assert int(response.headers['Content-Length']) == len(response.content)
+        results.append(response.content)
+
+    assert results[0] == results[1]
+    assert get_metric('blob_store_writes_total') - writes_before == 1
+    assert get_metric('blob_store_dedup_total') - dedup_before == 1
+
+# results close to the 1 MiB OUTPUT_MAX_BYTES cap, images are large on their own
+def get_large_result_payload():
+    payload = get_unique_payload()
+    if 'code' in payload:
+        payload = {"translator": "python3", "code": f"print('x' * 900 * 1024)\n# {uuid.uuid4().hex}\n"}
+    return payload
+
+@extra('BLOB_STORE')
+def test_status_latency_with_results(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    count = int(os.environ.get('BLOB_BENCH_TASKS', 1000))
+
+    task_ids = []
+    for start in range(0, count, 100):
+        batch = submit_tasks(headers, min(100, count - start), get_large_result_payload)
+        wait_for_all(batch, headers, timeout=600)
+        task_ids.extend(batch)
+
+    latencies = measure_status_latency(headers, task_ids)
+    print(f"\n{os.environ.get('BLOB_STORE_MODE', 'fs')} results, {len(task_ids)} tasks: "
+          f"status p50 {percentile(latencies, 0.5) * 1000:.2f}ms, p99 {percentile(latencies, 0.99) * 1000:.2f}ms")
+
+@extra('STATUS_CACHE')
+def test_status_cache_polling_load(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_ids = submit_tasks(headers, 10)
+    wait_for_all(task_ids, headers)
+
+    queries_before = get_metric('db_queries_total', query='status')
+    hits_before = get_metric('status_cache_hits_total')
+
+    rate = concurrent_status_polling(headers, task_ids)
+
+    queries = get_metric('db_queries_total', query='status') - queries_before
+    hits = get_metric('status_cache_hits_total') - hits_before
+    print(f"\nstatus: {rate:.0f} req/s, {hits:.0f} cache hits, {queries:.0f} status queries to the DB")
+
+    assert queries <= len(task_ids), "status polling still goes to the DB"
+
+@extra('STATUS_CACHE')
+def test_status_cache_commit_race(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    task_ids = submit_tasks(headers, 20)
+    regressions = []
+
+    def poll(task_id):
+        seen_ready = False
+        deadline = time.monotonic() + 120
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                response = session.get(f"{BASE_URL}/status/{task_id}", headers=headers)
+                assert response.status_code == 200
+                status = response.json()['status']
+                if seen_ready and status != 'ready':
+                    regressions.append(task_id)
+                    return
+                if status == 'ready':
+                    if not seen_ready:
+                        assert session.get(f"{BASE_URL}/result/{task_id}", headers=headers).status_code == 200
+                    seen_ready = True
+                    deadline = min(deadline, time.monotonic() + 1)
+
+    with ThreadPoolExecutor(max_workers=len(task_ids) * 3) as executor:
+        list(executor.map(poll, task_ids * 3))
+
+    assert not regressions, f"status went back from ready for {set(regressions)}"
+    wait_for_all(task_ids, headers)
+
+STAGES = ['queue_wait', 'sandbox_start', 'compile', 'run', 'decode', 'filter', 'encode', 'commit']
+
+@extra('STAGE_METRICS')
+def test_stage_metrics_add_up(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    payload = get_payload()
+    label = {'translator': payload['translator']} if 'code' in payload else {'filter': payload['filter']['name']}
+
+    stages_before = {stage: get_metric('task_stage_seconds_sum', PROCESSOR_METRICS_URL, stage=stage, **label) for stage in STAGES}
+    total_before = get_metric('task_end_to_end_seconds_sum')
+    count_before = get_metric('task_end_to_end_seconds_count')
+
+    count = 50
+    wait_for_all(submit_tasks(headers, count), headers, timeout=600)
+
+    # a task is ready once committed, the processor may still be recording its last stages
+    deadline = time.monotonic() + 5
+    while get_metric('tasks_in_flight', PROCESSOR_METRICS_URL) > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert get_metric('tasks_in_flight', PROCESSOR_METRICS_URL) == 0
+
+    stages = {stage: get_metric('task_stage_seconds_sum', PROCESSOR_METRICS_URL, stage=stage, **label) - stages_before[stage] for stage in STAGES}
+    total = get_metric('task_end_to_end_seconds_sum') - total_before
+    print()
+    for stage, seconds in stages.items():
+        print(f"{stage}: {seconds * 1000 / count:.2f}ms per task")
+    print(f"end to end: {total * 1000 / count:.2f}ms per task")
+
+    assert get_metric('task_end_to_end_seconds_count') - count_before == count
+    assert 0.8 * total <= sum(stages.values()) <= 1.05 * total, "stages do not add up to end-to-end latency"
+
+@extra('PROFILING')
+def test_profile_under_load(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    with ThreadPoolExecutor(max_workers=len(PROFILE_TARGETS)) as executor:
+        profiles = {service: executor.submit(fetch_profile, url, 5) for service, url in PROFILE_TARGETS.items()}
+        task_ids = submit_tasks(headers, 20)
+        concurrent_status_polling(headers, task_ids, threads=8, requests_per_thread=100)
+        profiles = {service: profile.result() for service, profile in profiles.items()}
+
+    for service, profile in profiles.items():
+        samples = 0
+        for line in profile.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            assert stack and int(count) > 0, f"{service}: bad collapsed stack line {line!r}"
+            samples += int(count)
+        print(f"\n{service}: {samples} samples, {len(profile.splitlines())} unique stacks")
+        assert samples > 0
+    wait_for_all(task_ids, headers)
+
+# (seconds from start, tasks submitted at once)
+BURSTY_TRACE = [(0, 5), (10, 150), (15, 50), (60, 5), (90, 200), (150, 5)]
+
+def replay_trace(headers, trace, tracker):
+    start = time.monotonic()
+    for offset, count in trace:
+        time.sleep(max(0, start + offset - time.monotonic()))
+        submit_tasks_timed(headers, count, tracker)
+
+@extra('AUTOSCALER')
+def test_autoscaler_bursty_trace(auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    min_workers = get_metric('autoscaler_min_workers', AUTOSCALER_METRICS_URL)
+    max_workers = get_metric('autoscaler_max_workers', AUTOSCALER_METRICS_URL)
+    worker_seconds_before = get_metric('autoscaler_worker_seconds_total', AUTOSCALER_METRICS_URL)
+    ups_before = get_metric('autoscaler_decisions_total', AUTOSCALER_METRICS_URL, direction='up')
+    downs_before = get_metric('autoscaler_decisions_total', AUTOSCALER_METRICS_URL, direction='down')
+
+    # completions are tracked while the trace is still being replayed
+    peak_workers = 0
+    with TurnaroundTracker() as tracker, ThreadPoolExecutor(max_workers=1) as executor:
+        replay = executor.submit(replay_trace, headers, BURSTY_TRACE, tracker)
+        while not replay.done():
+            peak_workers = max(peak_workers, get_metric('autoscaler_workers', AUTOSCALER_METRICS_URL))
+            time.sleep(1)
+        replay.result()
+        completion = list(tracker.wait(timeout=900).values())
+
+    worker_seconds = get_metric('autoscaler_worker_seconds_total', AUTOSCALER_METRICS_URL) - worker_seconds_before
+    ups = get_metric('autoscaler_decisions_total', AUTOSCALER_METRICS_URL, direction='up') - ups_before
+    downs = get_metric('autoscaler_decisions_total', AUTOSCALER_METRICS_URL, direction='down') - downs_before
+    print(f"\n{len(completion)} tasks: p95 completion {percentile(completion, 0.95):.2f}s, "
+          f"{worker_seconds:.0f} worker-seconds, peak {peak_workers:.0f} workers, {ups:.0f} up / {downs:.0f} down")
+
+    assert ups > 0, "autoscaler did not react to bursts"
+    assert peak_workers <= max_workers
+
+    # after the trace the queue is empty, cooldown must bring workers back to the minimum
+    deadline = time.monotonic() + 300
+    while get_metric('autoscaler_workers', AUTOSCALER_METRICS_URL) > min_workers and time.monotonic() < deadline:
+        time.sleep(5)
+    assert get_metric('autoscaler_workers', AUTOSCALER_METRICS_URL) == min_workers
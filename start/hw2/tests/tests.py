@@ -6,7 +6,9 @@ import subprocess
 import threading
 import signal
 import json
+import base64
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 try:
@@ -659,6 +661,25 @@ class CryptoServerTestRunner:
                 if response.status_code != 401:
                     self.warning(f"Ожидался статус 401 для {method} {endpoint} без токена, получен: {response.status_code}")
 
+            if self.auth_token:
+                headers = {"Authorization": f"Bearer {self.auth_token}"}
+                # warm up a possible verification cache before sending forged tokens
+                requests.get(f"{self.server_url}/crypto", headers=headers, timeout=5)
+
+                for forged_token in self.forge_tokens(self.auth_token):
+                    response = requests.get(
+                        f"{self.server_url}/crypto",
+                        headers={"Authorization": f"Bearer {forged_token}"},
+                        timeout=5
+                    )
+                    if response.status_code != 401:
+                        self.error(f"Токен с подделанной подписью или payload принят: {response.status_code}")
+                        return False
+
+            if os.environ.get('AUTH_LOAD') == '1':
+                if not self.benchmark_authenticated_get():
+                    return False
+
             self.success("Проверка требования аутентификации завершена")
             return True
 
@@ -669,6 +690,114 @@ class CryptoServerTestRunner:
             self.error(f"Неожиданная ошибка при тестировании аутентификации: {e}")
             return False
 
+    @staticmethod
+    def forge_tokens(token):
+        parts = token.split(".")
+        if len(parts) != 3:
+            return []
+
+        header, payload, signature = parts
+        middle = len(signature) // 2
+        flipped = "A" if signature[middle] != "A" else "B"
+        forged_signature = signature[:middle] + flipped + signature[middle + 1:]
+
+        forged = [f"{header}.{payload}.{forged_signature}"]
+
+        try:
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except ValueError:
+            return forged
+        claims["forged"] = True
+        forged_payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b"=").decode()
+        forged.append(f"{header}.{forged_payload}.{signature}")
+
+        return forged
+
+    def benchmark_authenticated_get(self, count=2000):
+        headers = {"Authorization": f"Bearer {self.auth_token}"}
+
+        start = time.monotonic()
+        latencies = self.measure_crypto_latency(headers, count=count)
+        elapsed = time.monotonic() - start
+
+        self.info(f"Аутентифицированный GET /crypto: {count / elapsed:.0f} rps, p99 {self.percentile(latencies, 0.99) * 1000:.2f}ms")
+        return True
+
+    @staticmethod
+    def percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def measure_crypto_latency(self, headers, count=None, until=None):
+        latencies = []
+        with requests.Session() as session:
+            while (count is not None and len(latencies) < count) or (until is not None and not until()):
+                start = time.monotonic()
+                response = session.get(f"{self.server_url}/crypto", headers=headers, timeout=10)
+                latencies.append(time.monotonic() - start)
+                if response.status_code != 200:
+                    raise RuntimeError(f"GET /crypto вернул {response.status_code}")
+        return latencies
+
+    def auth_request(self, endpoint, username):
+        for _ in range(30):
+            response = requests.post(
+                f"{self.server_url}/auth/{endpoint}",
+                json={"username": username, "password": self.test_password},
+                timeout=30
+            )
+            if response.status_code != 503:
+                return response.status_code
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        return 503
+
+    def test_login_storm(self):
+        try:
+            self.info("Тестирование шторма логинов...")
+
+            if not self.auth_token:
+                self.error("Нет токена для аутентификации")
+                return False
+
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            usernames = [f"storm_{self.test_username}_{i}" for i in range(200)]
+
+            with ThreadPoolExecutor(max_workers=20) as executor:
+                statuses = list(executor.map(lambda username: self.auth_request("register", username), usernames))
+            if any(status not in [200, 201] for status in statuses):
+                self.error("Не удалось зарегистрировать пользователей для шторма")
+                return False
+
+            baseline = self.measure_crypto_latency(headers, count=50)
+
+            with ThreadPoolExecutor(max_workers=len(usernames)) as executor:
+                futures = [executor.submit(self.auth_request, "login", username) for username in usernames]
+                storm = self.measure_crypto_latency(headers, until=lambda: all(f.done() for f in futures))
+                statuses = [f.result() for f in futures]
+
+            if any(status not in [200, 503] for status in statuses):
+                self.error(f"Неожиданные статусы при шторме логинов: {sorted(set(statuses))}")
+                return False
+
+            baseline_p99 = self.percentile(baseline, 0.99)
+            storm_p99 = self.percentile(storm, 0.99)
+            self.info(f"GET /crypto p99: без нагрузки {baseline_p99 * 1000:.1f}ms, во время шторма {storm_p99 * 1000:.1f}ms")
+            self.info(f"Успешных логинов: {statuses.count(200)}, отклонено с 503: {statuses.count(503)}")
+
+            if storm_p99 > max(3 * baseline_p99, baseline_p99 + 0.05):
+                self.error("Хеширование паролей блокирует обработку остальных запросов")
+                return False
+
+            self.success("Шторм логинов не влияет на остальные ручки")
+            return True
+
+        except requests.exceptions.RequestException as e:
+            self.error(f"Ошибка при тестировании шторма логинов: {e}")
+            return False
+        except Exception as e:
+            self.error(f"Неожиданная ошибка при шторме логинов: {e}")
+            return False
+
     def test_schedule_get(self):
         try:
             self.info("Тестирование получения настроек расписания...")
@@ -890,6 +1019,11 @@ class CryptoServerTestRunner:
             else:
                 self.log("ℹ️  Дополнительные тесты отключены (используйте SCHEDULE=1 для включения)", Fore.CYAN)
 
+            if os.environ.get('AUTH_LOAD') == '1':
+                self.log("🚨 Включены дополнительные тесты : Нагрузка на аутентификацию", Fore.YELLOW)
+                # append before deleting crypto, GET /crypto needs at least one entry
+                tests = tests[:-2] + [("Шторм логинов", self.test_login_storm)] + tests[-2:]
+
             all_passed = True
             for test_name, test_func in tests:
                 self.info(f"Выполнение: {test_name}")